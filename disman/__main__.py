@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
+import dataclasses
 import logging
-from typing import Optional
+import sys
+from typing import Callable, Optional, TypeVar
 
 import click
 
+import fleet
+import mirror
 import updater
 from datastore import DataStore
 from instance import DiscordInstance, DiscordEdition
+import instanceman
 from instanceman import InstanceManager
 import util
 
@@ -16,14 +21,16 @@ ds = DataStore()
 ds.open()
 instance_man = InstanceManager(ds)
 
+T = TypeVar('T')
 
-def _instance_search(query: str) -> Optional[DiscordInstance]:
+
+def _search(query: str, find: Callable[[str], list[T]], kind='instances') -> T:
     if len(query) < 3:
         click.echo('Error: query must be 3 or more characters long')
         raise click.Abort()
 
-    click.echo(f'Searching for instances matching "{query}"\n')
-    matches = instance_man.find(query)
+    click.echo(f'Searching for {kind} matching "{query}"\n')
+    matches = find(query)
     if not matches:
         click.echo('No matches found! Try being less specific.')
         raise click.Abort()
@@ -36,6 +43,55 @@ def _instance_search(query: str) -> Optional[DiscordInstance]:
         raise click.Abort()
 
 
+def _instance_search(query: str) -> Optional[DiscordInstance]:
+    return _search(query, instance_man.find)
+
+
+def _trash_search(query: str) -> instanceman.TrashEntry:
+    return _search(query, instance_man.find_trash, 'deleted instances')
+
+
+def _download(edition: DiscordEdition, version: str, quiet=False):
+    downloader = updater.download_instance(edition, version)
+
+    if quiet:
+        for report in downloader:
+            if report.done:
+                return report.file
+        return None
+
+    update_file = None
+    with click.progressbar(length=0, label=f'Downloading Discord - {edition.friendly_name}') as bar:
+        for report in downloader:
+            bar.length = report.total
+            bar.update(report.current - bar.pos)
+
+            if report.done:
+                update_file = report.file
+
+    return update_file
+
+
+def _parse_install_profile(instance: DiscordInstance, locales: Optional[str],
+                           exclude: tuple[str]) -> Optional[updater.InstallProfile]:
+    if locales is None and not exclude:  # keep whatever the instance was installed with
+        return None
+
+    # only override what was given, the rest stays as it was installed
+    profile = updater.get_install_profile(instance)
+    if locales is not None:
+        if locales.lower() == 'all':
+            chosen_locales = None
+        else:
+            chosen_locales = frozenset(locale.strip() for locale in locales.split(',') if locale.strip())
+        profile = dataclasses.replace(profile, locales=chosen_locales)
+    if exclude:
+        chosen_exclude = () if exclude == ('none',) else tuple(exclude)
+        profile = dataclasses.replace(profile, exclude=chosen_exclude)
+
+    return profile
+
+
 def _parse_edition(edition: str):
     try:
         return DiscordEdition(edition.lower())
@@ -46,7 +102,9 @@ def _parse_edition(edition: str):
 
 @click.group()
 @click.option('-v', '--verbose', is_flag=True)
-def cli(verbose: bool):
+@click.option('-m', '--mirror', 'mirrors', multiple=True, envvar='DISMAN_MIRRORS',
+              help='Mirror to download from before falling back to Discord. Can be given multiple times.')
+def cli(verbose: bool, mirrors: tuple[str]):
     if verbose:
         logging.basicConfig(
             level=logging.DEBUG
@@ -57,6 +115,8 @@ def cli(verbose: bool):
             level=logging.WARNING
         )
 
+    updater.set_mirrors(mirrors)
+
 
 @cli.command(name='create')
 @click.argument('name')
@@ -73,6 +133,31 @@ def create_instance(name: str):
     click.echo('\nDon\'t forget to initialize this instance using the "upgrade" command.')
 
 
+@cli.command(name='clone')
+@click.argument('query')
+@click.argument('name')
+@click.option('--exclude-caches', is_flag=True, help='Leave out cache directories of the instance data.')
+@click.option('--force', is_flag=True, help='Clone even if the instance is running.')
+@click.option('-j', '--jobs', default=8, type=int, help='Number of parallel workers.')
+def clone_instance(query: str, name: str, exclude_caches=False, force=False, jobs=8):
+    if len(name) < 3:
+        click.echo('Error: instance name must be 3 or more characters long')
+        return
+
+    instance = _instance_search(query)
+
+    click.echo(f'Cloning {instance.name} ({instance.uuid}) to {name}')
+    try:
+        clone = instance_man.clone(instance, name, exclude_caches, force, jobs)
+    except RuntimeError as e:
+        click.echo(f'Error: {e}')
+        return
+
+    click.echo(f'New instance created: {clone.name}')
+    click.echo(f'  - UUID:        {clone.uuid}')
+    click.echo(f'  - Created at:  {clone.created_at}')
+
+
 @cli.command(name='delete')
 @click.argument('query')
 @click.option('-y', '--yes', is_flag=True)
@@ -84,6 +169,48 @@ def delete_instance(query: str, yes=False):
         click.confirm('Continue?', abort=True)
     instance.delete()
 
+    retention_days = instanceman.TRASH_RETENTION // (24 * 60 * 60)
+    click.echo(f'Moved to trash. Use "undelete" to restore it within {retention_days} days, '
+               f'or "gc --all" to free up space now.')
+
+
+@cli.command(name='trash')
+def list_trash():
+    entries = instance_man.trash
+
+    for entry in entries:
+        click.echo(f'Instance: {entry.name} ({entry.uuid})')
+        click.echo(f'  - Deleted:     {util.utc_dt_to_relative_string(entry.deleted_at)}\n')
+
+    click.echo(f'Total deleted instances: {len(entries)}')
+
+
+@cli.command(name='undelete')
+@click.argument('query')
+def undelete_instance(query: str):
+    entry = _trash_search(query)
+
+    try:
+        instance = instance_man.undelete(entry)
+    except RuntimeError as e:
+        click.echo(f'Error: {e}')
+        return
+
+    click.echo(f'Restored {instance.name} ({instance.uuid})')
+
+
+@cli.command(name='gc')
+@click.option('--all', 'purge_all', is_flag=True, help='Purge all deleted instances, regardless of age.')
+@click.option('-j', '--jobs', default=8, type=int, help='Number of parallel workers.')
+def collect_garbage(purge_all=False, jobs=8):
+    """Permanently remove deleted instances once their undelete window has passed."""
+    max_age = 0 if purge_all else instanceman.TRASH_RETENTION
+    purged = instance_man.gc(max_age, jobs)
+
+    for entry in purged:
+        click.echo(f'Purged {entry.name} ({entry.uuid})')
+    click.echo(f'Total purged instances: {len(purged)}')
+
 
 @cli.command(name='list')
 def list_instances():
@@ -94,10 +221,13 @@ def list_instances():
         if edition is not None:
             edition = edition.friendly_name or 'Unknown'
         version = instance.version or 'Unknown'
+        profile = updater.get_install_profile(instance)
 
         click.echo(f'Instance: {instance.name}')
         click.echo(f'  - Edition:     {edition}')
         click.echo(f'  - Version:     {version}')
+        if profile.locales is not None:
+            click.echo(f'  - Locales:     {", ".join(sorted(profile.locales))}')
         click.echo(f'  - Created at:  {util.utc_dt_to_relative_string(instance.created_at)}\n')
 
     click.echo(f'Total instances: {len(instances)}')
@@ -108,8 +238,13 @@ def list_instances():
 @click.option('-e', '--edition')
 @click.option('-y', '--yes', is_flag=True)
 @click.option('--force-cross-upgrade', is_flag=True)
-def upgrade_instance(query: str, edition, yes=False, force_cross_upgrade=False):
+@click.option('--locales', help='Comma-separated locales to install, or "all". '
+                                'Defaults to the locales of the current installation.')
+@click.option('--exclude', multiple=True, help='Glob pattern of app files to leave out, or "none". Can be given '
+                                                'multiple times. Defaults to the patterns of the current installation.')
+def upgrade_instance(query: str, edition, yes=False, force_cross_upgrade=False, locales=None, exclude=()):
     instance = _instance_search(query)
+    profile = _parse_install_profile(instance, locales, exclude)
 
     installed_edition = instance.edition
     if edition is None:
@@ -135,23 +270,100 @@ def upgrade_instance(query: str, edition, yes=False, force_cross_upgrade=False):
         click.confirm('Continue?', abort=True)
         click.echo()
 
-    downloader = updater.download_instance(chosen_edition, latest_version)
-
-    update_file = None
-    with click.progressbar(length=0, label=f'Downloading Discord - {chosen_edition.friendly_name}') as bar:
-        for report in downloader:
-            bar.length = report.total
-            bar.update(report.current - bar.pos)
-
-            if report.done:
-                update_file = report.file
-
+    update_file = _download(chosen_edition, latest_version)
     if update_file is None:
         click.echo('Download failed!')
         return
 
     click.echo('Installing...')
-    updater.install_update(instance, chosen_edition, update_file)
+    try:
+        updater.install_update(instance, chosen_edition, update_file, profile)
+    except updater.UpdateError as e:
+        click.echo(f'Error: {e}')
+        return
+    click.echo('Done!')
+
+
+@cli.command(name='prefetch')
+@click.argument('query', required=False)
+@click.option('-q', '--quiet', is_flag=True)
+def prefetch_instances(query: Optional[str], quiet=False):
+    """Download and stage new versions in the background, to be applied on next start."""
+    instances = [_instance_search(query)] if query is not None else instance_man.instances
+
+    # failures are cached per edition too, so one outage doesn't get retried for every instance
+    latest_versions = {}
+    update_files = {}
+    failed = False
+    for instance in instances:
+        edition = instance.edition
+        if edition is None:  # not initialized, nothing to upgrade
+            continue
+
+        try:
+            if edition not in latest_versions:
+                try:
+                    latest_versions[edition] = updater.get_version(edition)
+                except updater.UpdateError as e:
+                    latest_versions[edition] = e
+            latest_version = latest_versions[edition]
+            if isinstance(latest_version, updater.UpdateError):
+                raise latest_version
+
+            pending = updater.get_pending_version(instance)
+            if pending is not None:
+                pending_version = updater.get_staged_build_info(instance, pending).get('version')
+            else:
+                pending_version = None
+            if latest_version in (instance.version, pending_version):
+                if not quiet:
+                    click.echo(f'{instance.name}: up to date')
+                continue
+
+            # editions share their tarball, so only download each one once
+            if edition not in update_files:
+                try:
+                    update_files[edition] = _download(edition, latest_version, quiet)
+                except updater.UpdateError as e:
+                    update_files[edition] = e
+            update_file = update_files[edition]
+            if isinstance(update_file, updater.UpdateError):
+                raise update_file
+            if update_file is None:
+                raise updater.UpdateError('download failed')
+
+            update_file.seek(0)
+            updater.prefetch_update(instance, edition, update_file)
+        except (updater.UpdateError, OSError) as e:
+            # always report errors, even when quiet, so cron mails them
+            click.echo(f'{instance.name}: error: {e}', err=True)
+            failed = True
+            continue
+
+        if not quiet:
+            click.echo(f'{instance.name}: staged v{latest_version}, will be applied on next start')
+
+    if failed:
+        sys.exit(1)
+
+
+@cli.command(name='rollback')
+@click.argument('query')
+@click.option('-y', '--yes', is_flag=True)
+def rollback_instance(query: str, yes=False):
+    instance = _instance_search(query)
+
+    previous = updater.get_previous_version(instance)
+    if previous is None:
+        click.echo('Error: no previous version to roll back to.')
+        return
+
+    previous_version = updater.get_staged_build_info(instance, previous).get('version', 'Unknown')
+    click.echo(f'Rolling back "{instance.name}" from v{instance.version or "Unknown"} to v{previous_version}')
+    if not yes:
+        click.confirm('Continue?', abort=True)
+
+    updater.rollback(instance)
     click.echo('Done!')
 
 
@@ -165,7 +377,12 @@ def upgrade_instance(query: str):
 
         return
 
+    if (applied := updater.apply_pending_update(instance)) is not None:
+        click.echo(f'Applied prefetched update: v{instance.version or applied}')
+
     instance.start()
+    # other processes of this edition are stopped now, so versions they were holding on to can go
+    updater.prune_versions(instance)
 
 
 @cli.command(name='migrate')
@@ -198,5 +415,95 @@ def migrate(edition: str, yes=False):
         click.confirm('Continue?', abort=True)
 
 
+@cli.command(name='apply')
+@click.argument('spec_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('-y', '--yes', is_flag=True)
+@click.option('--dry-run', is_flag=True, help='Only print the plan.')
+@click.option('-j', '--jobs', default=fleet.DEFAULT_WORKERS, type=int, help='Number of parallel downloads/installs.')
+@click.option('--force-cross-upgrade', is_flag=True)
+def apply_fleet(spec_file: str, yes=False, dry_run=False, jobs=fleet.DEFAULT_WORKERS, force_cross_upgrade=False):
+    try:
+        spec = fleet.load_spec(spec_file)
+        actions = fleet.plan(spec, instance_man, force_cross_upgrade)
+    except fleet.CrossUpgradeError as e:
+        click.echo(f'Error: {e}')
+        click.echo('Use --force-cross-upgrade to switch editions anyway. This is NOT recommended.')
+        return
+    except (fleet.FleetError, updater.UpdateError) as e:
+        click.echo(f'Error: {e}')
+        return
+
+    if not actions:
+        click.echo('Nothing to do, all instances match the spec.')
+        return
+
+    click.echo('Plan:')
+    for action in actions:
+        if action.type == fleet.ActionType.CREATE:
+            click.echo(f'  + create   {action.name}')
+        elif action.type == fleet.ActionType.DELETE:
+            click.echo(f'  - delete   {action.name}')
+        else:
+            current = 'new'
+            if action.instance is not None and action.instance.version is not None:
+                current = f'v{action.instance.version}'
+            click.echo(f'  ~ install  {action.name}: {current} -> v{action.version} - {action.edition.friendly_name}')
+            if action.cross_upgrade:
+                click.echo(f'      WARNING: cross-upgrading from {action.instance.edition.friendly_name} '
+                           f'to {action.edition.friendly_name}')
+    click.echo()
+
+    if dry_run:
+        return
+    if not yes:
+        click.confirm('Continue?', abort=True)
+
+    failures = fleet.execute(actions, instance_man, jobs)
+    for action, error in failures:
+        click.echo(f'Failed to {action.type.name.lower()} {action.name}: {error}')
+
+    click.echo(f'Done! {len(actions) - len(failures)}/{len(actions)} actions succeeded.')
+
+
+@cli.group(name='mirror')
+def mirror_group():
+    pass
+
+
+@mirror_group.command(name='serve')
+@click.option('-h', '--host', default='0.0.0.0')
+@click.option('-p', '--port', default=mirror.DEFAULT_PORT, type=int)
+@click.option('--ttl', default=mirror.DEFAULT_MANIFEST_TTL, type=int,
+              help='Seconds before version manifests are refreshed from upstream.')
+@click.option('--offline', is_flag=True, help='Only serve what is already cached.')
+def mirror_serve(host: str, port: int, ttl: int, offline=False):
+    store = mirror.MirrorStore(manifest_ttl=ttl, offline=offline)
+    server = mirror.MirrorServer((host, port), store)
+
+    click.echo(f'Serving mirror on http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@mirror_group.command(name='fetch')
+@click.argument('editions', nargs=-1)
+def mirror_fetch(editions: tuple[str]):
+    chosen_editions = [_parse_edition(e) for e in editions] or list(DiscordEdition)
+    store = mirror.MirrorStore(manifest_ttl=0)
+
+    try:
+        cached = mirror.prefetch(store, chosen_editions)
+    except mirror.MirrorError as e:
+        click.echo(f'Error: {e}')
+        return
+
+    for edition, version in cached:
+        click.echo(f'Cached {edition.friendly_name} v{version}')
+
+
 if __name__ == '__main__':
     cli()
@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+from contextlib import contextmanager
 from datetime import datetime
 
 import migrations
@@ -19,8 +20,24 @@ class DataStore:
         self._path = path or _get_default_path()
 
         self._data = {}
+        self._transaction_depth = 0
+
+    @contextmanager
+    def transaction(self):
+        """Defers writing to disk until the outermost transaction is done."""
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.save()
 
     def save(self):
+        if self._transaction_depth:
+            logging.debug('In transaction, deferring datastore save')
+            return
+
         logging.debug('Saving datastore to disk')
         with open(self._path, 'w+') as file:
             json.dump(self._data, file)
@@ -70,7 +87,7 @@ class DataStore:
         instances[instance.uuid] = {
             'name': instance.name,
             'uuid': instance.uuid,
-            'created_at': instance.created_at.timestamp()
+            'created_at': util.utc_dt_to_timestamp(instance.created_at)
         }
         self._data['instances'] = instances
 
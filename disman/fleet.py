@@ -0,0 +1,227 @@
+"""Declarative fleet specs: describe the instances a machine should have, and converge to them in one pass."""
+
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # python < 3.11
+    import tomli as tomllib
+
+import updater
+from instance import DiscordInstance, DiscordEdition
+from instanceman import InstanceManager
+
+logging.getLogger(__name__)
+
+LATEST = 'latest'
+DEFAULT_WORKERS = 4
+
+
+class FleetError(Exception):
+    pass
+
+
+class CrossUpgradeError(FleetError):
+    pass
+
+
+@dataclass()
+class InstanceSpec:
+    name: str
+    edition: DiscordEdition
+    version: str  # a version number, or LATEST
+    profile: updater.InstallProfile
+
+
+@dataclass()
+class FleetSpec:
+    instances: list[InstanceSpec]
+    prune: bool  # delete instances that are not in the spec
+
+
+class ActionType(Enum):
+    CREATE = '+'
+    INSTALL = '~'
+    DELETE = '-'
+
+
+@dataclass()
+class Action:
+    type: ActionType
+    name: str
+    instance: Optional[DiscordInstance] = None
+    edition: Optional[DiscordEdition] = None
+    version: Optional[str] = None
+    profile: Optional[updater.InstallProfile] = None
+    cross_upgrade: bool = False  # installs a different edition over an existing one
+
+
+def _parse_instance_spec(data: dict) -> InstanceSpec:
+    try:
+        name = str(data['name'])
+    except KeyError:
+        raise FleetError('Instance is missing a name')
+    if len(name) < 3:
+        raise FleetError(f'Instance name must be 3 or more characters long: "{name}"')
+
+    try:
+        edition = DiscordEdition(str(data.get('edition', DiscordEdition.STABLE.code_name)).lower())
+    except ValueError:
+        raise FleetError(f'Invalid edition for "{name}": {data["edition"]}')
+
+    locales = data.get('locales', None)
+    if locales is not None and not isinstance(locales, list):
+        raise FleetError(f'Locales of "{name}" must be a list')
+    exclude = data.get('exclude', [])
+    if not isinstance(exclude, list):
+        raise FleetError(f'Exclude patterns of "{name}" must be a list')
+
+    return InstanceSpec(
+        name=name,
+        edition=edition,
+        version=str(data.get('version', LATEST)),
+        profile=updater.InstallProfile(
+            locales=frozenset(locales) if locales is not None else None,
+            exclude=tuple(exclude)
+        )
+    )
+
+
+def load_spec(path: str) -> FleetSpec:
+    """
+    Loads a fleet spec from a TOML file, e.g.:
+
+        prune = true
+
+        [[instances]]
+        name = "main"
+        edition = "canary"
+        version = "latest"
+        locales = ["en-US", "nl"]
+    """
+    try:
+        with open(path, 'rb') as file:
+            data = tomllib.load(file)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        raise FleetError(f'Could not read fleet spec: {e}')
+
+    instances = [_parse_instance_spec(ins_data) for ins_data in data.get('instances', [])]
+
+    names = [spec.name.lower() for spec in instances]
+    if len(set(names)) != len(names):
+        raise FleetError('Instance names in fleet spec must be unique')
+
+    return FleetSpec(
+        instances=instances,
+        prune=bool(data.get('prune', False))
+    )
+
+
+def plan(spec: FleetSpec, instance_man: InstanceManager, force_cross_upgrade=False) -> list[Action]:
+    """
+    Computes the actions needed to get from the current state to the spec.
+    Instances are matched by name; "latest" is resolved once per edition.
+
+    :param force_cross_upgrade: allow installing a different edition over an installed one
+    """
+    existing = {}
+    for instance in instance_man.instances:
+        key = instance.name.lower()
+        if key in existing:
+            raise FleetError(f'More than one instance is named "{instance.name}", cannot match it to the spec')
+        existing[key] = instance
+
+    latest_versions = {}
+    actions = []
+    for ins_spec in spec.instances:
+        version = ins_spec.version
+        if version == LATEST:
+            if ins_spec.edition not in latest_versions:
+                latest_versions[ins_spec.edition] = updater.get_version(ins_spec.edition)
+            version = latest_versions[ins_spec.edition]
+
+        install = Action(ActionType.INSTALL, ins_spec.name, edition=ins_spec.edition,
+                         version=version, profile=ins_spec.profile)
+
+        instance = existing.pop(ins_spec.name.lower(), None)
+        if instance is None:
+            actions.append(Action(ActionType.CREATE, ins_spec.name))
+            actions.append(install)
+            continue
+
+        install.instance = instance
+        installed_edition = instance.edition
+        if installed_edition is not None and installed_edition != ins_spec.edition:
+            if not force_cross_upgrade:
+                raise CrossUpgradeError(f'"{instance.name}" has {installed_edition.friendly_name} installed '
+                                        f'but the spec wants {ins_spec.edition.friendly_name}')
+            install.cross_upgrade = True
+
+        if (install.cross_upgrade
+                or instance.version != version
+                or updater.get_install_profile(instance) != ins_spec.profile):
+            actions.append(install)
+
+    if spec.prune:
+        for instance in existing.values():
+            actions.append(Action(ActionType.DELETE, instance.name, instance=instance))
+
+    return actions
+
+
+def _download(edition: DiscordEdition, version: str) -> bytes:
+    for report in updater.download_instance(edition, version):
+        if report.done:
+            return report.file.getvalue()
+
+    raise updater.UpdateError(f'Download failed: {edition.code_name}-{version}')
+
+
+def execute(actions: list[Action], instance_man: InstanceManager, workers=DEFAULT_WORKERS):
+    """
+    Runs a plan. Creates and deletes are committed to the datastore in a single transaction
+    before anything is installed. Every (edition, version) pair is downloaded once and installs run in parallel.
+
+    :return: list of (action, exception) tuples for actions that failed
+    """
+    failures = []
+
+    with instance_man.transaction():
+        for action in actions:
+            if action.type == ActionType.CREATE:
+                created = instance_man.create(action.name)
+                for other in actions:  # point the follow-up install to the new instance
+                    if other.type == ActionType.INSTALL and other.name == action.name:
+                        other.instance = created
+            elif action.type == ActionType.DELETE:
+                try:
+                    instance_man.delete(action.instance)
+                except (OSError, RuntimeError) as e:
+                    failures.append((action, e))
+
+    # installs don't touch the datastore, so the transaction is already committed at this point
+    installs = [action for action in actions if action.type == ActionType.INSTALL]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        downloads = {
+            key: executor.submit(_download, *key)
+            for key in {(action.edition, action.version) for action in installs}
+        }
+
+        def install(action: Action):
+            update_file = io.BytesIO(downloads[(action.edition, action.version)].result())
+            updater.install_update(action.instance, action.edition, update_file, action.profile)
+
+        futures = [(action, executor.submit(install, action)) for action in installs]
+        for action, future in futures:
+            try:
+                future.result()
+            except (OSError, updater.UpdateError) as e:
+                logging.error(f'Could not install {action.name}: {e}')
+                failures.append((action, e))
+
+    return failures
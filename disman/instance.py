@@ -64,6 +64,10 @@ class DiscordInstance:
     def app_dir(self):
         return os.path.join(self.base_dir, 'app/')
 
+    @property
+    def versions_dir(self):
+        return os.path.join(self.base_dir, 'versions/')
+
     @property
     def data_dir(self):
         return os.path.join(self.base_dir, 'data/')
@@ -1,11 +1,59 @@
+import json
+import logging
+import os
 import shutil
+import time
 import uuid
+from dataclasses import dataclass
 from datetime import datetime
+from typing import Iterable, TypeVar
 
+import updater
+import util
 from datastore import DataStore
 from instance import DiscordInstance
 from process import DiscordProcess, ProcessState
 
+logging.getLogger(__name__)
+
+TRASH_RETENTION = 7 * 24 * 60 * 60  # in seconds
+TRASH_RECORD = 'instance.json'
+PURGING_PREFIX = '.purging-'
+
+T = TypeVar('T')
+
+# chromium locks that belong to the process of the source instance
+CLONE_EXCLUDE = ('Singleton*',)
+CACHE_DIRS = ('Cache', 'Code Cache', 'GPUCache', 'DawnCache', 'DawnGraphiteCache', 'DawnWebGPUCache',
+              'ShaderCache', 'GrShaderCache', 'GraphiteDawnCache', 'CacheStorage', 'ScriptCache')
+
+
+@dataclass()
+class TrashEntry:
+    path: str
+    name: str
+    uuid: str
+    created_at: datetime
+    deleted_at: datetime
+
+    @property
+    def instance_dir(self):
+        return os.path.join(self.path, 'instance')
+
+
+def _match(query: str, items: Iterable[T]) -> list[T]:
+    """Finds instances (or anything else with a name and uuid) matching a search query."""
+    exact_matches = []
+    roughly_matches = []
+    for item in items:
+        if query.lower() == item.name.lower() or query.lower() == item.uuid:
+            exact_matches.append(item)
+        elif query.lower() in item.name.lower() or query.lower() in item.uuid:
+            roughly_matches.append(item)
+
+    # if we found exact matches then don't return the inexact ones
+    return exact_matches or roughly_matches
+
 
 class InstanceManager:
     def __init__(self, ds: DataStore):
@@ -19,11 +67,14 @@ class InstanceManager:
 
         return instances
 
+    def transaction(self):
+        return self._ds.transaction()
+
     def create(self, name):
         instance = DiscordInstance(
             name=name,
             uuid=str(uuid.uuid4()),
-            created_at=datetime.now()
+            created_at=datetime.utcnow()
         )
         instance.manager = self
 
@@ -31,24 +82,167 @@ class InstanceManager:
 
         return instance
 
-    def delete(self, instance: DiscordInstance):
+    def delete(self, instance: DiscordInstance) -> TrashEntry:
+        """
+        Moves an instance to the trash. Its files stay there until they are purged by `gc`,
+        so it can still be restored using `undelete`.
+        """
+        deleted_at = time.time()
+        entry_dir = os.path.join(util.get_trash_dir(), f'{instance.uuid}-{int(deleted_at)}')
+        os.makedirs(entry_dir)
+
+        with open(os.path.join(entry_dir, TRASH_RECORD), 'w+') as file:
+            json.dump({
+                'name': instance.name,
+                'uuid': instance.uuid,
+                'created_at': util.utc_dt_to_timestamp(instance.created_at),
+                'deleted_at': deleted_at
+            }, file)
+
         try:
-            shutil.rmtree(instance.base_dir)
+            os.rename(instance.base_dir, os.path.join(entry_dir, 'instance'))
         except FileNotFoundError:  # probably not initialized (yet), not an issue
             pass
         self._ds.delete_instance(instance.uuid)
 
+        return TrashEntry(
+            path=entry_dir,
+            name=instance.name,
+            uuid=instance.uuid,
+            created_at=instance.created_at,
+            deleted_at=datetime.utcfromtimestamp(deleted_at)
+        )
+
+    def clone(self, instance: DiscordInstance, name: str, exclude_caches=False, force=False,
+              workers=8) -> DiscordInstance:
+        """
+        Creates a new instance with a copy of the active app version and data of an existing one.
+        App files are never modified in place, so they can be hardlinked if reflinks are not supported.
+
+        :param force: clone even if the instance is running; its data (databases, cookies) may be copied mid-write
+        """
+        if not force and updater._get_versions_in_use(instance):
+            raise RuntimeError(f'{instance.name} is running, close it first or force the clone')
+
+        clone = DiscordInstance(
+            name=name,
+            uuid=str(uuid.uuid4()),
+            created_at=datetime.utcnow()
+        )
+        clone.manager = self
+
+        app_link = instance.app_dir.rstrip('/')
+        active_version = updater.get_active_version(instance)
+        try:
+            os.makedirs(clone.base_dir)
+            if active_version is not None:
+                util.clone_tree(os.path.join(instance.versions_dir, active_version),
+                                os.path.join(clone.versions_dir, active_version),
+                                hardlink=True, workers=workers)
+                os.symlink(os.readlink(app_link), clone.app_dir.rstrip('/'))
+            elif os.path.isdir(app_link):  # installed before staged upgrades
+                util.clone_tree(app_link, clone.app_dir, hardlink=True, workers=workers)
+
+            if os.path.isdir(instance.data_dir):
+                exclude = CLONE_EXCLUDE + (CACHE_DIRS if exclude_caches else ())
+                util.clone_tree(instance.data_dir, clone.data_dir, exclude=exclude, workers=workers)
+        except BaseException:
+            shutil.rmtree(clone.base_dir, ignore_errors=True)
+            raise
+
+        self._ds.save_instance(clone)
+
+        return clone
+
+    @property
+    def trash(self) -> list[TrashEntry]:
+        entries = []
+        try:
+            dir_entries = list(os.scandir(util.get_trash_dir()))
+        except FileNotFoundError:
+            return []
+
+        for dir_entry in dir_entries:
+            if dir_entry.name.startswith(PURGING_PREFIX) or not dir_entry.is_dir(follow_symlinks=False):
+                continue
+
+            try:
+                with open(os.path.join(dir_entry.path, TRASH_RECORD), 'r') as file:
+                    data = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                logging.warning(f'Invalid trash entry: {dir_entry.path}')
+                continue
+
+            entries.append(TrashEntry(
+                path=dir_entry.path,
+                name=data['name'],
+                uuid=data['uuid'],
+                created_at=datetime.utcfromtimestamp(data['created_at']),
+                deleted_at=datetime.utcfromtimestamp(data['deleted_at'])
+            ))
+
+        return sorted(entries, key=lambda e: e.deleted_at)
+
+    def undelete(self, entry: TrashEntry) -> DiscordInstance:
+        instance = DiscordInstance(
+            name=entry.name,
+            uuid=entry.uuid,
+            created_at=entry.created_at
+        )
+        instance.manager = self
+
+        if os.path.exists(instance.base_dir):
+            raise RuntimeError(f'Instance directory already exists: {instance.base_dir}')
+
+        try:
+            os.rename(entry.instance_dir, instance.base_dir)
+        except FileNotFoundError:  # was never initialized
+            pass
+        self._ds.save_instance(instance)
+
+        os.unlink(os.path.join(entry.path, TRASH_RECORD))
+        os.rmdir(entry.path)
+
+        return instance
+
+    def gc(self, max_age=TRASH_RETENTION, workers=8) -> list[TrashEntry]:
+        """
+        Permanently removes trash entries older than `max_age` seconds.
+
+        :return: list of purged entries
+        """
+        trash_dir = util.get_trash_dir()
+        now = datetime.utcnow()
+        purged = []
+
+        for entry in self.trash:
+            if (now - entry.deleted_at).total_seconds() < max_age:
+                continue
+
+            # rename first, so the entry can't be restored halfway through
+            purging_path = os.path.join(trash_dir, PURGING_PREFIX + os.path.basename(entry.path))
+            os.rename(entry.path, purging_path)
+            util.rmtree_parallel(purging_path, workers)
+            purged.append(entry)
+
+        # finish off purges that were interrupted
+        try:
+            leftovers = [e.path for e in os.scandir(trash_dir) if e.name.startswith(PURGING_PREFIX)]
+        except FileNotFoundError:
+            leftovers = []
+        for path in leftovers:
+            util.rmtree_parallel(path, workers)
+
+        return purged
+
     def find(self, query: str):
-        exact_matches = []
-        roughly_matches = []
-        for instance in self.instances:
-            if query.lower() == instance.name.lower() or query.lower() == instance.uuid:
-                exact_matches.append(instance)
-            elif query.lower() in instance.name.lower() or query.lower() in instance.uuid:
-                roughly_matches.append(instance)
-
-        # if we found exact matches then don't return the inexact ones
-        return exact_matches or roughly_matches
+        return _match(query, self.instances)
+
+    def find_trash(self, query: str) -> list[TrashEntry]:
+        # a delete that got interrupted before the instance left the datastore can be run again,
+        # which leaves an older entry with the same uuid behind; only the latest one is restorable
+        latest = {entry.uuid: entry for entry in self.trash}
+        return _match(query, latest.values())
 
     def start(self, instance: DiscordInstance):
         process = DiscordProcess(instance)
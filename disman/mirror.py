@@ -0,0 +1,426 @@
+"""A small HTTP mirror serving cached Discord tarballs and version manifests to other disman clients."""
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse
+
+import updater
+import util
+from instance import DiscordEdition
+
+logging.getLogger(__name__)
+
+DEFAULT_PORT = 8080
+DEFAULT_MANIFEST_TTL = 300  # in seconds
+
+_VERSION_RE = re.compile(r'^\d+(\.\d+)*$')
+_UPDATES_RE = re.compile(r'^/updates/(?P<edition>\w+)/?$')
+_APPS_RE = re.compile(r'^/apps/(?P<edition>\w+)/(?P<version>[\d.]+)\.tar\.gz$')
+_RANGE_RE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+
+class MirrorError(Exception):
+    pass
+
+
+class MirrorStore:
+    """
+    On-disk cache of version manifests and tarballs.
+    Anything that is missing gets pulled from upstream exactly once, even if
+    multiple clients ask for it at the same time.
+    """
+
+    def __init__(self, path=None, manifest_ttl=DEFAULT_MANIFEST_TTL, offline=False):
+        self._path = path or util.get_mirror_dir()
+        self.manifest_ttl = manifest_ttl
+        self.offline = offline
+
+        self._locks: dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._fetches: dict[str, _Fetch] = {}
+        self._fetches_lock = threading.Lock()
+
+    def _lock(self, key: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def manifest_path(self, edition: DiscordEdition):
+        return os.path.join(self._path, 'manifests', f'{edition.code_name}.json')
+
+    def artifact_path(self, edition: DiscordEdition, version: str):
+        if not _VERSION_RE.match(version):
+            raise MirrorError(f'Invalid version: {version}')
+
+        return os.path.join(self._path, 'apps', edition.code_name, f'{version}.tar.gz')
+
+    def get_version(self, edition: DiscordEdition) -> str:
+        """
+        Gets the latest version of an edition, refreshing the cached manifest
+        from upstream once it is older than the TTL.
+        If upstream cannot be reached, a stale manifest is still served.
+        """
+        path = self.manifest_path(edition)
+
+        with self._lock(path):
+            try:
+                with open(path, 'r') as file:
+                    manifest = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                manifest = None
+
+            if manifest is not None and (self.offline or time.time() - manifest['fetched_at'] < self.manifest_ttl):
+                return manifest['name']
+            if self.offline:
+                raise MirrorError(f'No cached manifest for {edition.friendly_name}')
+
+            try:
+                version = updater.get_version(edition, use_mirrors=False)
+            except updater.UpdateError as e:
+                if manifest is None:
+                    raise MirrorError(f'Could not fetch manifest: {e}')
+
+                logging.warning(f'Could not refresh manifest, serving stale version: {e}')
+                return manifest['name']
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _atomic_write(path, json.dumps({'name': version, 'fetched_at': time.time()}).encode())
+
+            return version
+
+    def _fetch(self, fetch: '_Fetch', edition: DiscordEdition, version: str):
+        logging.info(f'Fetching {edition.code_name}-{version} from upstream')
+        try:
+            with open(fetch.tmp_path, 'wb') as file:
+                for report in updater.download_instance(edition, version, use_mirrors=False, file=file):
+                    file.flush()
+                    fetch.update(report.current, report.total)
+
+            # the temp file only goes away while holding the condition, so streaming clients can't miss it
+            with fetch.cond:
+                os.replace(fetch.tmp_path, fetch.path)
+                fetch.finish()
+        except Exception as e:  # waiting clients must always be released
+            logging.error(f'Could not fetch {edition.code_name}-{version}: {e}')
+            with fetch.cond:
+                try:
+                    os.unlink(fetch.tmp_path)
+                except FileNotFoundError:
+                    pass
+                fetch.finish(MirrorError(str(e)))
+        finally:
+            with self._fetches_lock:
+                del self._fetches[fetch.path]
+
+    def open_artifact(self, edition: DiscordEdition, version: str) -> 'str | _Fetch':
+        """
+        Gets the path to a cached tarball. On a cache miss, a download from upstream is started
+        (if one isn't running already) and returned, so clients can be served while it is in progress.
+        """
+        path = self.artifact_path(edition, version)
+        if os.path.isfile(path):
+            return path
+
+        with self._fetches_lock:
+            if os.path.isfile(path):  # a fetch finished while we were waiting
+                return path
+            if path in self._fetches:
+                return self._fetches[path]
+            if self.offline:
+                raise MirrorError(f'Not cached: {edition.code_name}-{version}')
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+            os.close(fd)
+
+            fetch = _Fetch(path, tmp_path)
+            self._fetches[path] = fetch
+            threading.Thread(target=self._fetch, args=(fetch, edition, version), daemon=True).start()
+
+            return fetch
+
+    def get_artifact(self, edition: DiscordEdition, version: str) -> str:
+        """
+        Gets the path to a cached tarball, waiting for it to be downloaded from upstream if needed.
+        """
+        artifact = self.open_artifact(edition, version)
+        if isinstance(artifact, str):
+            return artifact
+
+        artifact.wait()
+        return artifact.path
+
+
+class _Fetch:
+    """Progress of a tarball that is being downloaded into the mirror."""
+
+    def __init__(self, path: str, tmp_path: str):
+        self.path = path
+        self.tmp_path = tmp_path
+
+        self.total: Optional[int] = None
+        self.written = 0
+        self.done = False
+        self.error: Optional[MirrorError] = None
+        self.cond = threading.Condition(threading.RLock())
+
+    def update(self, written: int, total: int):
+        with self.cond:
+            self.written = written
+            self.total = total
+            self.cond.notify_all()
+
+    def finish(self, error: Optional[MirrorError] = None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.done)
+        if self.error is not None:
+            raise self.error
+
+    def wait_for_total(self) -> int:
+        with self.cond:
+            self.cond.wait_for(lambda: self.total is not None or self.done)
+        if self.error is not None:
+            raise self.error
+        return self.total
+
+    def wait_for_data(self, offset: int) -> int:
+        """
+        Waits until more than `offset` bytes have been written.
+
+        :return: number of bytes written so far
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.written > offset or self.done)
+            if self.error is not None:
+                raise self.error
+            return self.written
+
+
+def _atomic_write(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """
+    Parses a single-range Range header.
+
+    :return: inclusive (start, end) tuple, or None to serve the whole file
+    :raises ValueError: if the range cannot be satisfied
+    """
+    if not header:
+        return None
+
+    match = _RANGE_RE.match(header.strip())
+    if match is None:  # multiple or malformed ranges, just send everything
+        return None
+
+    start, end = match.group('start'), match.group('end')
+    if not start and not end:
+        return None
+    if not start:  # suffix range, e.g. the last 500 bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+
+    return start, end
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    server: 'MirrorServer'
+
+    def log_message(self, fmt, *args):
+        logging.info(f'{self.address_string()} - {fmt % args}')
+
+    def _send_error(self, status: HTTPStatus, msg: str):
+        body = json.dumps({'message': msg}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _handle(self):
+        path = urlparse(self.path).path
+
+        if match := _UPDATES_RE.match(path):
+            self._serve_manifest(match.group('edition'))
+        elif match := _APPS_RE.match(path):
+            self._serve_artifact(match.group('edition'), match.group('version'))
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, 'Not found')
+
+    def _resolve_edition(self, code_name: str) -> Optional[DiscordEdition]:
+        try:
+            return DiscordEdition(code_name)
+        except ValueError:
+            self._send_error(HTTPStatus.NOT_FOUND, f'Unknown edition: {code_name}')
+            return None
+
+    def _serve_manifest(self, code_name: str):
+        edition = self._resolve_edition(code_name)
+        if edition is None:
+            return
+
+        try:
+            version = self.server.store.get_version(edition)
+        except MirrorError as e:
+            self._send_error(HTTPStatus.BAD_GATEWAY, str(e))
+            return
+
+        body = json.dumps({'name': version}).encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_file_headers(self, status: HTTPStatus, length: int):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/gzip')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+
+    def _stream_fetch(self, fetch: '_Fetch'):
+        """Passes a tarball through to the client while the mirror is still downloading it."""
+        with fetch.cond:
+            if fetch.done:  # moved into the cache or failed, either way wait() knows what to do
+                return False
+            file = open(fetch.tmp_path, 'rb')
+
+        with file:
+            try:
+                total = fetch.wait_for_total()
+            except MirrorError as e:
+                self._send_error(HTTPStatus.BAD_GATEWAY, str(e))
+                return True
+
+            self._send_file_headers(HTTPStatus.OK, total)
+            self.end_headers()
+            if self.command == 'HEAD':
+                return True
+
+            sent = 0
+            while sent < total:
+                try:
+                    available = fetch.wait_for_data(sent)
+                except MirrorError:
+                    # headers are out already, so all we can do is cut the client off
+                    self.close_connection = True
+                    return True
+
+                while sent < available:
+                    chunk = file.read(min(available - sent, 64 * 1024))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+
+        return True
+
+    def _serve_artifact(self, code_name: str, version: str):
+        edition = self._resolve_edition(code_name)
+        if edition is None:
+            return
+
+        try:
+            artifact = self.server.store.open_artifact(edition, version)
+            if not isinstance(artifact, str):
+                # ranges are only served from the cache, so wait for the download to finish
+                if not self.headers.get('Range') and self._stream_fetch(artifact):
+                    return
+                artifact.wait()
+                artifact = artifact.path
+        except MirrorError as e:
+            self._send_error(HTTPStatus.NOT_FOUND, str(e))
+            return
+
+        with open(artifact, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            try:
+                byte_range = _parse_range(self.headers.get('Range'), size)
+            except ValueError:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, end = 0, size - 1
+                self._send_file_headers(HTTPStatus.OK, size)
+            else:
+                start, end = byte_range
+                self._send_file_headers(HTTPStatus.PARTIAL_CONTENT, end - start + 1)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+
+            if self.command == 'HEAD':
+                return
+
+            length = end - start + 1
+            file.seek(start)
+            while length > 0:
+                chunk = file.read(min(length, 64 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                length -= len(chunk)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._handle()
+
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], store: MirrorStore):
+        super().__init__(address, MirrorRequestHandler)
+        self.store = store
+
+
+def prefetch(store: MirrorStore, editions=tuple(DiscordEdition)):
+    """
+    Fills the mirror with the latest version of each given edition.
+
+    :return: list of (edition, version) tuples that are now cached
+    """
+    cached = []
+    for edition in editions:
+        version = store.get_version(edition)
+        store.get_artifact(edition, version)
+        cached.append((edition, version))
+
+    return cached
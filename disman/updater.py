@@ -1,10 +1,17 @@
+import fnmatch
 import io
+import json
 import logging
 import os
+import shutil
 import tarfile
+import tempfile
+import time
 from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Optional
 
 import httpx
+import psutil
 
 import util
 from instance import DiscordInstance, DiscordEdition
@@ -18,31 +25,104 @@ DL_ENDPOINTS = {
     DiscordEdition.CANARY: 'https://dl-canary.discordapp.net/apps/{plat}/{v}/discord-canary-{v}.tar.gz'
 }
 
+MIRROR_DL_PATH = '/apps/{edition}/{v}.tar.gz'
+
+PENDING_MARKER = '.pending'
+PREVIOUS_MARKER = '.previous'
+STAGING_PREFIX = '.staging-'
+STALE_STAGING_AGE = 24 * 60 * 60  # in seconds
+INSTALL_MANIFEST = '.disman-install.json'
+LOCK_FILE = '.lock'
+FALLBACK_LOCALE = 'en-US'
+
+MIRROR_TIMEOUT = httpx.Timeout(5.0, read=60.0)
+
 client = httpx.Client()
+mirrors: list[str] = []
 
 
 @dataclass()
 class DownloadStatusReport:
     current: int  # in bytes
     total: int  # in bytes
-    file: io.BytesIO
+    file: BinaryIO
     done: bool
 
 
+@dataclass()
+class InstallProfile:
+    locales: Optional[frozenset[str]] = None  # None means all locales
+    exclude: tuple[str, ...] = ()  # glob patterns, relative to the app dir
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'InstallProfile':
+        locales = data.get('locales', None)
+        return cls(
+            locales=frozenset(locales) if locales is not None else None,
+            exclude=tuple(data.get('exclude', ()))
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'locales': sorted(self.locales) if self.locales is not None else None,
+            'exclude': list(self.exclude)
+        }
+
+    def should_skip(self, path: str) -> bool:
+        """
+        Checks whether a file should be left out of the installation.
+
+        :param path: path of the file relative to the app dir
+        """
+        locale = _get_locale(path)
+        if self.locales is not None and locale is not None:
+            # chromium falls back to en-US, so never drop it
+            if locale.lower() != FALLBACK_LOCALE.lower() and locale.lower() not in self._wanted_locales:
+                return True
+
+        return any(fnmatch.fnmatch(path, pattern) for pattern in self.exclude)
+
+    @property
+    def _wanted_locales(self) -> set[str]:
+        return {locale.lower() for locale in self.locales}
+
+    def missing_locales(self, paths: Iterable[str]) -> set[str]:
+        """
+        Finds the wanted locales that have no locale file among the given paths.
+
+        :param paths: paths of the files relative to the app dir
+        """
+        if self.locales is None:
+            return set()
+
+        available = {locale.lower() for locale in map(_get_locale, paths) if locale is not None}
+        return {locale for locale in self.locales if locale.lower() not in available}
+
+
+def _get_locale(path: str) -> Optional[str]:
+    """Gets the locale of a chromium locale file, e.g. locales/en-US.pak, or None for other files."""
+    if os.path.dirname(path) != 'locales':
+        return None
+
+    return os.path.basename(path).split('.')[0]
+
+
 class UpdateError(Exception):
     pass
 
 
-def get_version(edition=DiscordEdition.STABLE) -> str:
+def set_mirrors(urls: Iterable[str]):
     """
-    Gets the latest Discord version according to Discord's servers.
-    We do this by pretending as if we're running version 0.0.0 so Discord
-    will serve us the latest client version.
+    Sets the mirrors to query before falling back to Discord's servers.
+    Mirrors are tried in the order they are given.
 
-    :return: version as str
+    :param urls: base URLs of the mirrors, e.g. http://10.0.0.2:8080
     """
-    logging.info('Getting latest client version')
-    r = client.get(f'{API_ENDPOINT}/updates/{edition.code_name}', params={
+    mirrors[:] = [url.rstrip('/') for url in urls]
+
+
+def _fetch_version(endpoint: str, edition: DiscordEdition) -> str:
+    r = client.get(f'{endpoint}/updates/{edition.code_name}', params={
         'platform': 'linux',
         'version': '0.0.0'
     })
@@ -52,61 +132,128 @@ def get_version(edition=DiscordEdition.STABLE) -> str:
     try:
         data = r.json()
         return data['name']
-    except httpx.DecodingError:
+    except (httpx.DecodingError, ValueError):
         raise UpdateError(f'Could not parse API response: {r.text}')
     except KeyError:
         raise UpdateError(f'Could not find version in API response: {r.text}')
 
 
-def download_instance(edition: DiscordEdition, version=None):
+def get_version(edition=DiscordEdition.STABLE, use_mirrors=True) -> str:
+    """
+    Gets the latest Discord version according to Discord's servers.
+    We do this by pretending as if we're running version 0.0.0 so Discord
+    will serve us the latest client version.
+
+    Configured mirrors are asked first; Discord itself is only contacted
+    if none of them can answer.
+
+    :return: version as str
+    """
+    logging.info('Getting latest client version')
+    endpoints = (mirrors if use_mirrors else []) + [API_ENDPOINT]
+
+    for endpoint in endpoints[:-1]:
+        try:
+            return _fetch_version(endpoint, edition)
+        except (httpx.HTTPError, UpdateError) as e:
+            logging.warning(f'Mirror {endpoint} failed, trying next source: {e}')
+
+    try:
+        return _fetch_version(endpoints[-1], edition)
+    except httpx.HTTPError as e:
+        raise UpdateError(f'Could not reach update server: {e}')
+
+
+def _get_download_urls(edition: DiscordEdition, version: str, use_mirrors=True) -> list[str]:
     url = DL_ENDPOINTS.get(edition, None)
     if url is None:
         raise UpdateError(f'Could not find download URL for edition: {edition}')
-    url = url.format(plat='linux', v=version)
 
+    urls = [mirror + MIRROR_DL_PATH.format(edition=edition.code_name, v=version)
+            for mirror in (mirrors if use_mirrors else [])]
+    urls.append(url.format(plat='linux', v=version))
+
+    return urls
+
+
+def download_instance(edition: DiscordEdition, version=None, use_mirrors=True, file: Optional[BinaryIO] = None):
+    """
+    Downloads a client tarball, trying the configured mirrors first.
+
+    :param file: file to write the tarball to, defaults to an in-memory buffer
+    """
     # use latest version if not specified
     if version is None:
-        version = get_version()
+        version = get_version(edition, use_mirrors)
 
-    # download tarball
-    logging.info(f'Downloading archive: {url}')
-    buf = io.BytesIO()
-    downloaded = 0
+    urls = _get_download_urls(edition, version, use_mirrors)
+    buf = file if file is not None else io.BytesIO()
+    for i, url in enumerate(urls):
+        is_last = i == len(urls) - 1
+        # a cold mirror may still be fetching from upstream, so give it time between chunks
+        timeout = client.timeout if is_last else MIRROR_TIMEOUT
 
-    with client.stream('GET', url) as r:
-        if r.status_code == 404:
-            raise UpdateError(f'Could not find version on server: {edition}-{version}')
-        elif r.status_code != 200:
-            raise UpdateError(f'Unknown HTTP error while fetching client tarball: {r.status_code}')
+        # download tarball
+        logging.info(f'Downloading archive: {url}')
+        buf.seek(0)
+        buf.truncate()
+        downloaded = 0
 
-        total_size = int(r.headers['Content-Length'])
-        for data in r.iter_bytes():
-            buf.write(data)
-            downloaded += len(data)
-            yield DownloadStatusReport(downloaded, total_size, buf, False)
+        try:
+            with client.stream('GET', url, timeout=timeout) as r:
+                if r.status_code == 404:
+                    raise UpdateError(f'Could not find version on server: {edition}-{version}')
+                elif r.status_code != 200:
+                    raise UpdateError(f'Unknown HTTP error while fetching client tarball: {r.status_code}')
 
-    buf.seek(0)
-    yield DownloadStatusReport(downloaded, total_size, buf, True)
+                try:
+                    total_size = int(r.headers['Content-Length'])
+                except (KeyError, ValueError):
+                    raise UpdateError(f'Missing or invalid Content-Length from {url}')
+                for data in r.iter_bytes():
+                    buf.write(data)
+                    downloaded += len(data)
+                    yield DownloadStatusReport(downloaded, total_size, buf, False)
+        except (httpx.HTTPError, UpdateError) as e:
+            if is_last:
+                if isinstance(e, UpdateError):
+                    raise
+                raise UpdateError(f'Could not download client tarball: {e}')
 
+            logging.warning(f'Mirror download failed, trying next source: {e}')
+            continue
+
+        buf.seek(0)
+        yield DownloadStatusReport(downloaded, total_size, buf, True)
+        return
 
-def install_update(instance: 'DiscordInstance', edition: DiscordEdition, update_file: io.BytesIO):
-    logging.info(f'Installing Discord to {instance.app_dir}')
-    os.makedirs(instance.app_dir, exist_ok=True)
+
+def _extract_update(dest_dir: str, edition: DiscordEdition, update_file: io.BytesIO, profile: InstallProfile):
+    skipped = []
 
     with tarfile.open(fileobj=update_file, mode='r:gz') as archive:
         members = archive.getmembers()
         executable = util.find_executable_path(edition, (m.path for m in members if m.isfile()))
+        if executable is None:
+            raise UpdateError(f'Could not find {edition.executable} in update archive')
         common_path = os.path.dirname(executable)
 
+        # check the profile before writing anything, a typo would otherwise silently drop a wanted locale
+        missing = profile.missing_locales(os.path.relpath(m.path, common_path) for m in members if m.isfile())
+        if missing:
+            raise UpdateError(f'Locales not found in update archive: {", ".join(sorted(missing))}')
+
         for member in members:
             if not member.isfile():  # we only need the files
                 continue
 
+            rel_path = os.path.relpath(member.path, common_path)
+            if profile.should_skip(rel_path):
+                skipped.append(rel_path)
+                continue
+
             # calculate dest directory and create required dirs
-            dest = os.path.join(
-                instance.app_dir,
-                os.path.relpath(member.path, common_path)
-            )
+            dest = os.path.join(dest_dir, rel_path)
             os.makedirs(os.path.dirname(dest), exist_ok=True)
 
             # extract member to dest and set permissions
@@ -114,3 +261,311 @@ def install_update(instance: 'DiscordInstance', edition: DiscordEdition, update_
             with open(dest, 'wb+') as target:
                 target.write(file.read())
             os.chmod(dest, member.mode)
+
+    # record what we left out, so later upgrades can apply the same profile
+    with open(os.path.join(dest_dir, INSTALL_MANIFEST), 'w+') as file:
+        json.dump({
+            'profile': profile.to_dict(),
+            'skipped': skipped
+        }, file)
+
+
+def _read_marker(instance: 'DiscordInstance', marker: str) -> Optional[str]:
+    try:
+        with open(os.path.join(instance.versions_dir, marker), 'r') as file:
+            name = file.read().strip()
+    except FileNotFoundError:
+        return None
+
+    # ignore markers pointing to versions that no longer exist
+    if not name or not os.path.isdir(os.path.join(instance.versions_dir, name)):
+        return None
+    return name
+
+
+def _write_marker(instance: 'DiscordInstance', marker: str, name: Optional[str]):
+    path = os.path.join(instance.versions_dir, marker)
+    if name is None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return
+
+    with open(f'{path}.tmp', 'w+') as file:
+        file.write(name)
+    os.replace(f'{path}.tmp', path)
+
+
+def _unique_version_name(instance: 'DiscordInstance', version: str) -> str:
+    name = version
+    i = 0
+    while os.path.exists(os.path.join(instance.versions_dir, name)):
+        i += 1
+        name = f'{version}-{i}'
+
+    return name
+
+
+def _migrate_legacy_app_dir(instance: 'DiscordInstance'):
+    """
+    Moves an app directory from before staged installs into the versions directory,
+    so it can be swapped out like any other version.
+    """
+    link = instance.app_dir.rstrip('/')
+    if os.path.islink(link) or not os.path.isdir(link):
+        return
+
+    name = _unique_version_name(instance, instance.version or 'legacy')
+    logging.info(f'Moving legacy app directory to {name}')
+    os.makedirs(instance.versions_dir, exist_ok=True)
+    os.rename(link, os.path.join(instance.versions_dir, name))
+    os.symlink(os.path.join('versions', name), link)
+
+
+def get_active_version(instance: 'DiscordInstance') -> Optional[str]:
+    link = instance.app_dir.rstrip('/')
+    if not os.path.islink(link):
+        return None
+
+    return os.path.basename(os.readlink(link))
+
+
+def get_pending_version(instance: 'DiscordInstance') -> Optional[str]:
+    return _read_marker(instance, PENDING_MARKER)
+
+
+def get_previous_version(instance: 'DiscordInstance') -> Optional[str]:
+    return _read_marker(instance, PREVIOUS_MARKER)
+
+
+def get_staged_build_info(instance: 'DiscordInstance', name: str) -> dict:
+    target = os.path.join(instance.versions_dir, name, 'resources/build_info.json')
+    try:
+        with open(target, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def get_install_manifest(instance: 'DiscordInstance') -> dict:
+    target = os.path.join(instance.app_dir, INSTALL_MANIFEST)
+    try:
+        with open(target, 'r') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def get_install_profile(instance: 'DiscordInstance') -> InstallProfile:
+    """
+    Gets the profile the active version was installed with.
+    Installations without a manifest were installed in full.
+    """
+    return InstallProfile.from_dict(get_install_manifest(instance).get('profile', {}))
+
+
+def _versions_lock(instance: 'DiscordInstance'):
+    """
+    Serializes changes to the versions of an instance, e.g. between a cron prefetch and an interactive upgrade.
+    Staged versions may only be renamed into place, (de)activated, marked or pruned while holding it.
+    """
+    return util.lock_file(os.path.join(instance.versions_dir, LOCK_FILE))
+
+
+def _extract_staged(instance: 'DiscordInstance', edition: DiscordEdition, update_file: io.BytesIO,
+                    profile: Optional[InstallProfile]) -> tuple[str, str]:
+    """
+    Extracts an update into a fresh staging directory. Doesn't need the versions lock,
+    since pruning leaves recent staging directories alone.
+
+    :return: tuple of (staging dir, version)
+    """
+    if profile is None:
+        profile = get_install_profile(instance)
+
+    os.makedirs(instance.versions_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=instance.versions_dir)
+    os.chmod(staging_dir, 0o755)  # mkdtemp only allows the owner in
+    logging.info(f'Staging update in {staging_dir}')
+
+    try:
+        _extract_update(staging_dir, edition, update_file, profile)
+
+        with open(os.path.join(staging_dir, 'resources/build_info.json'), 'r') as file:
+            version = json.load(file).get('version', 'unknown')
+    except (OSError, ValueError, tarfile.TarError) as e:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise UpdateError(f'Could not stage update: {e}')
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    return staging_dir, version
+
+
+def _commit_staged(instance: 'DiscordInstance', staging_dir: str, version: str) -> str:
+    name = _unique_version_name(instance, version)
+    os.rename(staging_dir, os.path.join(instance.versions_dir, name))
+
+    return name
+
+
+def stage_update(instance: 'DiscordInstance', edition: DiscordEdition, update_file: io.BytesIO,
+                 profile: Optional[InstallProfile] = None) -> str:
+    """
+    Extracts an update next to the active installation without touching it.
+    Note that an unmarked staged version may be pruned by the next update of this instance.
+
+    :param profile: files to leave out, defaults to the profile of the active installation
+    :return: name of the staged version
+    """
+    staging_dir, version = _extract_staged(instance, edition, update_file, profile)
+    with _versions_lock(instance):
+        return _commit_staged(instance, staging_dir, version)
+
+
+def _activate(instance: 'DiscordInstance', name: str):
+    if not os.path.isdir(os.path.join(instance.versions_dir, name)):
+        raise UpdateError(f'Version is not staged: {name}')
+
+    _migrate_legacy_app_dir(instance)
+    previous = get_active_version(instance)
+
+    # flip the symlink by renaming a new one over it, so there's never a moment without an app directory
+    link = instance.app_dir.rstrip('/')
+    tmp_link = f'{link}.tmp'
+    try:
+        os.unlink(tmp_link)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.path.join('versions', name), tmp_link)
+    os.replace(tmp_link, link)
+    logging.info(f'Activated version {name}')
+
+    if previous is not None and previous != name:
+        _write_marker(instance, PREVIOUS_MARKER, previous)
+    if get_pending_version(instance) == name:
+        _write_marker(instance, PENDING_MARKER, None)
+
+
+def activate_version(instance: 'DiscordInstance', name: str):
+    """
+    Atomically points the app directory of an instance to a staged version.
+    The version that was active before is kept around for rollbacks.
+    """
+    with _versions_lock(instance):
+        _activate(instance, name)
+        _prune(instance)
+
+
+def _get_versions_in_use(instance: 'DiscordInstance') -> set[str]:
+    """Finds the staged versions that running processes were started from."""
+    versions_dir = os.path.realpath(instance.versions_dir)
+    in_use = set()
+    for proc in psutil.process_iter(['exe']):
+        exe = proc.info['exe']  # None if we're not allowed to see it
+        if exe and exe.startswith(versions_dir + os.sep):
+            in_use.add(os.path.relpath(exe, versions_dir).split(os.sep)[0])
+
+    return in_use
+
+
+def _prune(instance: 'DiscordInstance'):
+    keep = {get_active_version(instance), get_pending_version(instance), get_previous_version(instance)}
+    keep |= _get_versions_in_use(instance)
+
+    try:
+        entries = list(os.scandir(instance.versions_dir))
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False) or entry.name in keep:
+            continue
+        if entry.name.startswith(STAGING_PREFIX):
+            # might still be in use by another process, so only clean up old ones
+            if time.time() - entry.stat().st_mtime < STALE_STAGING_AGE:
+                continue
+        elif entry.name.startswith('.'):
+            continue
+
+        logging.info(f'Removing unused version {entry.name}')
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def prune_versions(instance: 'DiscordInstance'):
+    """
+    Removes staged versions that are not active, pending, kept for rollbacks or still running,
+    as well as leftovers of interrupted installs.
+    """
+    with _versions_lock(instance):
+        _prune(instance)
+
+
+def install_update(instance: 'DiscordInstance', edition: DiscordEdition, update_file: io.BytesIO,
+                   profile: Optional[InstallProfile] = None):
+    logging.info(f'Installing Discord to {instance.app_dir}')
+
+    staging_dir, version = _extract_staged(instance, edition, update_file, profile)
+    with _versions_lock(instance):
+        name = _commit_staged(instance, staging_dir, version)
+        # an explicit upgrade supersedes whatever was prefetched before
+        _write_marker(instance, PENDING_MARKER, None)
+        _activate(instance, name)
+        _prune(instance)
+
+
+def prefetch_update(instance: 'DiscordInstance', edition: DiscordEdition, update_file: io.BytesIO,
+                    profile: Optional[InstallProfile] = None) -> str:
+    """
+    Stages an update to be activated the next time the instance is started.
+
+    :return: name of the staged version
+    """
+    staging_dir, version = _extract_staged(instance, edition, update_file, profile)
+    with _versions_lock(instance):
+        name = _commit_staged(instance, staging_dir, version)
+        _write_marker(instance, PENDING_MARKER, name)
+        _prune(instance)
+
+    return name
+
+
+def apply_pending_update(instance: 'DiscordInstance') -> Optional[str]:
+    """
+    Activates a prefetched update, if there is one.
+
+    :return: name of the activated version, or None
+    """
+    if get_pending_version(instance) is None:  # cheap check, so starting doesn't wait on a running prefetch
+        return None
+
+    with _versions_lock(instance):
+        name = get_pending_version(instance)
+        if name is None:
+            return None
+
+        _activate(instance, name)
+        _prune(instance)
+
+    return name
+
+
+def rollback(instance: 'DiscordInstance') -> str:
+    """
+    Switches back to the previously active version.
+
+    :return: name of the activated version
+    """
+    with _versions_lock(instance):
+        name = get_previous_version(instance)
+        if name is None:
+            raise UpdateError('No previous version available')
+
+        # don't let a pending update undo the rollback on next start
+        _write_marker(instance, PENDING_MARKER, None)
+        _activate(instance, name)
+        _prune(instance)
+
+    return name
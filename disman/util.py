@@ -1,13 +1,26 @@
+import errno
+import fnmatch
 import os
+import shutil
+import threading
 import typing
-from datetime import datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
 from typing import Iterable
 
 from babel.dates import format_timedelta
 
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
+
 if typing.TYPE_CHECKING:
     from instance import DiscordEdition
 
+FICLONE = 0x40049409  # linux ioctl to share extents between files (btrfs, xfs, ...)
+
 
 ###############
 # Directories #
@@ -29,6 +42,27 @@ def get_instances_dir():
     return os.path.join(get_config_dir(), 'instances/')
 
 
+def get_trash_dir():
+    # lives next to the instances so moving an instance to it is a cheap rename
+    return os.path.join(get_config_dir(), 'trash/')
+
+
+def get_system_cache_dir():
+    directory = os.environ.get('XDG_CACHE_HOME', None)
+    if directory is None:
+        directory = os.path.join('/home', os.environ.get('USER'), '.cache')
+
+    return directory
+
+
+def get_cache_dir():
+    return os.path.join(get_system_cache_dir(), 'discord-manager/')
+
+
+def get_mirror_dir():
+    return os.path.join(get_cache_dir(), 'mirror/')
+
+
 def get_original_discord_config_dir(edition: 'DiscordEdition'):
     return os.path.join(get_system_config_dir(), edition.conf_dir_name)
 
@@ -37,6 +71,11 @@ def get_original_discord_config_dir(edition: 'DiscordEdition'):
 # Miscellaneous #
 #################
 
+def utc_dt_to_timestamp(dt: datetime):
+    """Inverse of datetime.utcfromtimestamp; naive datetimes would otherwise be treated as local time."""
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+
 def utc_dt_to_relative_string(dt: datetime):
     delta = dt - datetime.utcnow()
     return format_timedelta(delta, granularity='second', add_direction=True)
@@ -62,3 +101,158 @@ def get_installed_discord_editions():
             editions.append((edition, edition_dir))
 
     return editions
+
+
+def _clear_dir(directory: str) -> list[str]:
+    """Unlinks everything in a directory except subdirectories, which are returned instead."""
+    subdirs = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+
+    return subdirs
+
+
+def rmtree_parallel(path: str, workers=8):
+    """
+    Like shutil.rmtree, but scans and unlinks directories in parallel.
+    Much faster for trees with many small files, like browser caches.
+    """
+    dirs = [path]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_clear_dir, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    dirs.append(subdir)
+                    pending.add(executor.submit(_clear_dir, subdir))
+
+    # subdirectories are always found after their parents, so this removes children first
+    for directory in reversed(dirs):
+        try:
+            os.rmdir(directory)
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def lock_file(path: str):
+    """
+    Holds an exclusive lock on a file for the duration of the block, blocking until it is available.
+    Locks are advisory and only work between processes (and threads) that use this function.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class _TreeCloner:
+    """
+    Copies files using the cheapest method available: reflinks, then hardlinks (if allowed), then regular copies.
+    Methods that turn out to be unsupported by the filesystem are not attempted again.
+    """
+
+    def __init__(self, hardlink: bool):
+        self.use_reflink = fcntl is not None
+        self.use_hardlink = hardlink
+        self._lock = threading.Lock()
+
+    def _disable(self, attr: str):
+        with self._lock:
+            setattr(self, attr, False)
+
+    def _reflink(self, src: str, dst: str) -> bool:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except OSError as e:
+                # don't leave an empty file behind
+                dst_file.close()
+                os.unlink(dst)
+                if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                    self._disable('use_reflink')
+                    return False
+                raise
+
+        shutil.copystat(src, dst)
+        return True
+
+    def _hardlink(self, src: str, dst: str) -> bool:
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                self._disable('use_hardlink')
+                return False
+            raise
+
+        return True
+
+    def copy_file(self, src: str, dst: str):
+        if self.use_reflink and self._reflink(src, dst):
+            return
+        if self.use_hardlink and self._hardlink(src, dst):
+            return
+
+        shutil.copy2(src, dst, follow_symlinks=False)
+
+
+def clone_tree(src: str, dst: str, hardlink=False, exclude: Iterable[str] = (), workers=8):
+    """
+    Recursively copies a directory, preferring copy-on-write reflinks where the filesystem supports them.
+    Symlinks are recreated as-is, sockets and other special files are skipped.
+
+    :param hardlink: allow hardlinking files; only safe for files that are never modified in place
+    :param exclude: glob patterns of file and directory names to leave out
+    """
+    exclude = tuple(exclude)
+    cloner = _TreeCloner(hardlink)
+
+    def is_excluded(name: str):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in exclude)
+
+    copied_dirs = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for root, dirs, files in os.walk(src):
+            dirs[:] = [d for d in dirs if not is_excluded(d)]
+            target_root = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(target_root, exist_ok=True)
+            copied_dirs.append((root, target_root))
+
+            # os.walk lists symlinks to directories as directories, but we want to keep them as links
+            for name in [d for d in dirs if os.path.islink(os.path.join(root, d))] + files:
+                if is_excluded(name):
+                    continue
+
+                path = os.path.join(root, name)
+                target = os.path.join(target_root, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), target)
+                elif os.path.isfile(path):
+                    futures.append(executor.submit(cloner.copy_file, path, target))
+            dirs[:] = [d for d in dirs if not os.path.islink(os.path.join(root, d))]
+
+        for future in futures:
+            future.result()
+
+    # only now that directories are filled, so they keep their mtime and read-only ones can still be written to
+    for root, target_root in reversed(copied_dirs):
+        shutil.copystat(root, target_root)
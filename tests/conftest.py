@@ -0,0 +1,57 @@
+import io
+import json
+import os
+import sys
+import tarfile
+
+import pytest
+
+# disman is run as a script, so its modules import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'disman'))
+
+from datastore import DataStore  # noqa: E402
+from instance import DiscordEdition  # noqa: E402
+from instanceman import InstanceManager  # noqa: E402
+
+LOCALES = ('en-US', 'nl', 'de', 'fr')
+
+
+def make_tarball(version: str, edition=DiscordEdition.STABLE, locales=LOCALES) -> bytes:
+    """Builds a minimal release tarball laid out like Discord's."""
+    files = {
+        edition.executable: b'#!/bin/sh\n',
+        'resources/build_info.json': json.dumps({
+            'releaseChannel': edition.code_name,
+            'version': version
+        }).encode(),
+    }
+    for locale in locales:
+        files[f'locales/{locale}.pak'] = locale.encode()
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+        for path, data in files.items():
+            info = tarfile.TarInfo(f'{edition.executable}/{path}')
+            info.size = len(data)
+            info.mode = 0o755
+            archive.addfile(info, io.BytesIO(data))
+
+    return buf.getvalue()
+
+
+def tarball_file(version: str, edition=DiscordEdition.STABLE, **kwargs) -> io.BytesIO:
+    return io.BytesIO(make_tarball(version, edition, **kwargs))
+
+
+@pytest.fixture()
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return tmp_path / 'config'
+
+
+@pytest.fixture()
+def instance_man(config_dir):
+    ds = DataStore()
+    ds.open()
+    return InstanceManager(ds)
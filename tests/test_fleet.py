@@ -0,0 +1,174 @@
+from collections import Counter
+
+import pytest
+
+import fleet
+import updater
+from conftest import make_tarball, tarball_file
+from datastore import DataStore
+from instance import DiscordEdition
+from instanceman import InstanceManager
+
+LATEST_VERSIONS = {
+    DiscordEdition.STABLE: '0.0.2',
+    DiscordEdition.CANARY: '0.0.50',
+}
+
+
+@pytest.fixture(autouse=True)
+def fake_updater(monkeypatch):
+    downloads = Counter()
+
+    def download(edition, version):
+        downloads[(edition, version)] += 1
+        return make_tarball(version, edition)
+
+    monkeypatch.setattr(updater, 'get_version', lambda edition=DiscordEdition.STABLE: LATEST_VERSIONS[edition])
+    monkeypatch.setattr(fleet, '_download', download)
+    return downloads
+
+
+def _spec(*instances, prune=False):
+    return fleet.FleetSpec(
+        instances=[
+            fleet.InstanceSpec(
+                name=ins['name'],
+                edition=ins.get('edition', DiscordEdition.STABLE),
+                version=ins.get('version', fleet.LATEST),
+                profile=ins.get('profile', updater.InstallProfile())
+            )
+            for ins in instances
+        ],
+        prune=prune
+    )
+
+
+def _summary(actions):
+    return [(action.type, action.name, action.version) for action in actions]
+
+
+def _install(instance_man, name, version, edition=DiscordEdition.STABLE, profile=None):
+    instance = instance_man.create(name)
+    updater.install_update(instance, edition, tarball_file(version, edition), profile)
+    return instance
+
+
+def test_load_spec(tmp_path):
+    path = tmp_path / 'fleet.toml'
+    path.write_text('prune = true\n'
+                    '[[instances]]\nname = "main"\nedition = "Canary"\nlocales = ["nl"]\n'
+                    '[[instances]]\nname = "pinned"\nversion = "0.0.1"\n')
+
+    spec = fleet.load_spec(str(path))
+
+    assert spec.prune
+    assert [(i.name, i.edition, i.version) for i in spec.instances] == [
+        ('main', DiscordEdition.CANARY, fleet.LATEST),
+        ('pinned', DiscordEdition.STABLE, '0.0.1'),
+    ]
+    assert spec.instances[0].profile == updater.InstallProfile(locales=frozenset({'nl'}))
+
+
+@pytest.mark.parametrize('contents', [
+    '[[instances]]\nname = "ab"\n',
+    '[[instances]]\nname = "main"\nedition = "nightly"\n',
+    '[[instances]]\nname = "main"\n[[instances]]\nname = "MAIN"\n',
+])
+def test_load_invalid_spec(tmp_path, contents):
+    path = tmp_path / 'fleet.toml'
+    path.write_text(contents)
+
+    with pytest.raises(fleet.FleetError):
+        fleet.load_spec(str(path))
+
+
+def test_plan_new_instances(instance_man):
+    actions = fleet.plan(_spec({'name': 'latest'}, {'name': 'pinned', 'version': '0.0.1'}), instance_man)
+
+    assert _summary(actions) == [
+        (fleet.ActionType.CREATE, 'latest', None),
+        (fleet.ActionType.INSTALL, 'latest', '0.0.2'),
+        (fleet.ActionType.CREATE, 'pinned', None),
+        (fleet.ActionType.INSTALL, 'pinned', '0.0.1'),
+    ]
+
+
+def test_plan_up_to_date(instance_man):
+    _install(instance_man, 'latest', '0.0.2')
+    _install(instance_man, 'pinned', '0.0.1')
+
+    assert fleet.plan(_spec({'name': 'LATEST'}, {'name': 'pinned', 'version': '0.0.1'}), instance_man) == []
+
+
+def test_plan_upgrades(instance_man):
+    _install(instance_man, 'outdated', '0.0.1')
+    _install(instance_man, 'pinned', '0.0.2')
+    _install(instance_man, 'slimmed', '0.0.2')
+    _install(instance_man, 'current', '0.0.2')
+
+    actions = fleet.plan(_spec(
+        {'name': 'outdated'},
+        {'name': 'pinned', 'version': '0.0.1'},
+        {'name': 'slimmed', 'profile': updater.InstallProfile(locales=frozenset({'nl'}))},
+        {'name': 'current'},
+    ), instance_man)
+
+    assert _summary(actions) == [
+        (fleet.ActionType.INSTALL, 'outdated', '0.0.2'),
+        (fleet.ActionType.INSTALL, 'pinned', '0.0.1'),
+        (fleet.ActionType.INSTALL, 'slimmed', '0.0.2'),
+    ]
+    assert all(action.instance is not None for action in actions)
+
+
+def test_plan_prune(instance_man):
+    instance_man.create('wanted')
+    instance_man.create('unwanted')
+
+    assert fleet.plan(_spec({'name': 'wanted', 'version': '0.0.1'}), instance_man)[-1].type == fleet.ActionType.INSTALL
+
+    actions = fleet.plan(_spec({'name': 'wanted', 'version': '0.0.1'}, prune=True), instance_man)
+    assert _summary(actions)[-1] == (fleet.ActionType.DELETE, 'unwanted', None)
+
+
+def test_plan_cross_upgrade(instance_man):
+    _install(instance_man, 'alpha', '0.0.2')
+    spec = _spec({'name': 'alpha', 'edition': DiscordEdition.CANARY})
+
+    with pytest.raises(fleet.CrossUpgradeError):
+        fleet.plan(spec, instance_man)
+
+    actions = fleet.plan(spec, instance_man, force_cross_upgrade=True)
+    assert _summary(actions) == [(fleet.ActionType.INSTALL, 'alpha', '0.0.50')]
+    assert actions[0].cross_upgrade
+
+
+def test_plan_duplicate_instance_names(instance_man):
+    instance_man.create('twin')
+    instance_man.create('twin')
+
+    with pytest.raises(fleet.FleetError):
+        fleet.plan(_spec({'name': 'twin'}), instance_man)
+
+
+def test_execute(instance_man, fake_updater):
+    _install(instance_man, 'outdated', '0.0.1')
+    instance_man.create('unwanted')
+    spec = _spec({'name': 'outdated'}, {'name': 'first'}, {'name': 'second'},
+                 {'name': 'pinned', 'version': '0.0.1'}, prune=True)
+
+    failures = fleet.execute(fleet.plan(spec, instance_man), instance_man)
+
+    assert failures == []
+    # everything is on disk, so a fresh datastore sees the same
+    ds = DataStore()
+    ds.open()
+    instances = {instance.name: instance for instance in InstanceManager(ds).instances}
+    assert sorted(instances) == ['first', 'outdated', 'pinned', 'second']
+    assert {name: instance.version for name, instance in instances.items()} == {
+        'outdated': '0.0.2', 'first': '0.0.2', 'second': '0.0.2', 'pinned': '0.0.1'
+    }
+    # each release is downloaded once, no matter how many instances use it
+    assert fake_updater == {(DiscordEdition.STABLE, '0.0.2'): 1, (DiscordEdition.STABLE, '0.0.1'): 1}
+
+    assert fleet.plan(spec, instance_man) == []
@@ -0,0 +1,156 @@
+import json
+import os
+import time
+
+import pytest
+
+import instanceman
+import updater
+import util
+from conftest import tarball_file
+from datastore import DataStore
+from instance import DiscordEdition
+from instanceman import InstanceManager
+
+DAY = 24 * 60 * 60
+
+
+def _reload():
+    ds = DataStore()
+    ds.open()
+    return InstanceManager(ds)
+
+
+def _backdate(entry, seconds):
+    record = os.path.join(entry.path, instanceman.TRASH_RECORD)
+    with open(record, 'r') as file:
+        data = json.load(file)
+    data['deleted_at'] -= seconds
+    with open(record, 'w') as file:
+        json.dump(data, file)
+
+
+@pytest.fixture()
+def local_tz(monkeypatch):
+    # make sure local time and UTC can't be mixed up unnoticed
+    monkeypatch.setenv('TZ', 'Etc/GMT-5')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_delete_undelete_round_trip(instance_man, local_tz):
+    instance = instance_man.create('test-instance')
+    os.makedirs(instance.data_dir)
+    with open(os.path.join(instance.data_dir, 'settings.json'), 'w') as file:
+        file.write('{}')
+    saved = _reload().find('test-instance')[0]
+
+    entry = instance_man.delete(instance)
+    assert instance_man.instances == []
+    assert not os.path.exists(instance.base_dir)
+
+    trashed, = _reload().find_trash('test-instance')
+    assert (trashed.path, trashed.uuid, trashed.created_at) == (entry.path, saved.uuid, saved.created_at)
+
+    instance_man.undelete(trashed)
+    restored, = _reload().instances
+    assert (restored.name, restored.uuid, restored.created_at) == (saved.name, saved.uuid, saved.created_at)
+    assert os.path.isfile(os.path.join(restored.data_dir, 'settings.json'))
+    assert instance_man.trash == []
+
+
+def test_undelete_uninitialized(instance_man):
+    entry = instance_man.delete(instance_man.create('test-instance'))
+
+    instance = instance_man.undelete(entry)
+
+    assert [i.uuid for i in instance_man.find('test-instance')] == [instance.uuid]
+    assert not os.path.exists(entry.path)
+
+
+def test_find_trash_latest_deletion(instance_man, monkeypatch):
+    instance = instance_man.create('test-instance')
+    clock = iter([1000.0, 2000.0])
+    monkeypatch.setattr(instanceman.time, 'time', lambda: next(clock))
+
+    # interrupt the first delete before it gets to the datastore, then run it again
+    delete_instance = instance_man._ds.delete_instance
+    def interrupt(uuid):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(instance_man._ds, 'delete_instance', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        instance_man.delete(instance)
+    monkeypatch.setattr(instance_man._ds, 'delete_instance', delete_instance)
+    newer = instance_man.delete(instance)
+
+    assert len(instance_man.trash) == 2
+    assert [entry.path for entry in instance_man.find_trash('test-instance')] == [newer.path]
+
+
+def test_gc(instance_man, local_tz):
+    old = instance_man.delete(instance_man.create('old-instance'))
+    fresh = instance_man.delete(instance_man.create('fresh-instance'))
+    _backdate(old, 8 * DAY)
+    _backdate(fresh, DAY)
+
+    purged = instance_man.gc()
+
+    assert [entry.path for entry in purged] == [old.path]
+    assert not os.path.exists(old.path)
+    assert [entry.path for entry in instance_man.trash] == [fresh.path]
+
+    assert [entry.path for entry in instance_man.gc(max_age=0)] == [fresh.path]
+    assert os.listdir(util.get_trash_dir()) == []
+
+
+def test_gc_interrupted_purge(instance_man):
+    leftover = os.path.join(util.get_trash_dir(), instanceman.PURGING_PREFIX + 'interrupted')
+    os.makedirs(os.path.join(leftover, 'instance', 'data'))
+    with open(os.path.join(leftover, 'instance', 'data', 'file'), 'w') as file:
+        file.write('data')
+
+    assert instance_man.trash == []
+    assert instance_man.gc() == []
+    assert not os.path.exists(leftover)
+
+
+def test_rmtree_parallel(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (outside / 'keep').write_text('keep')
+
+    tree = tmp_path / 'tree'
+    for i in range(20):
+        subdir = tree / str(i % 4) / str(i)
+        subdir.mkdir(parents=True)
+        (subdir / 'file').write_text(str(i))
+    (tree / 'link').symlink_to(outside, target_is_directory=True)
+    (tree / '0' / 'empty').mkdir()
+
+    util.rmtree_parallel(str(tree), workers=4)
+
+    assert not tree.exists()
+    assert (outside / 'keep').read_text() == 'keep'
+
+
+def test_clone(instance_man, monkeypatch):
+    instance = instance_man.create('test-instance')
+    updater.install_update(instance, DiscordEdition.STABLE, tarball_file('0.0.1'))
+    for name in ('Local Storage', 'Cache', 'SingletonLock'):
+        os.makedirs(os.path.join(instance.data_dir, name))
+
+    monkeypatch.setattr(updater, '_get_versions_in_use', lambda _: {'0.0.1'})
+    with pytest.raises(RuntimeError):
+        instance_man.clone(instance, 'clone')
+    assert [i.name for i in instance_man.instances] == ['test-instance']
+
+    clone = instance_man.clone(instance, 'clone', exclude_caches=True, force=True)
+
+    assert clone.uuid != instance.uuid
+    assert (clone.edition, clone.version) == (DiscordEdition.STABLE, '0.0.1')
+    assert updater.get_active_version(clone) == '0.0.1'
+    assert sorted(os.listdir(clone.data_dir)) == ['Local Storage']
+    assert sorted(i.name for i in _reload().instances) == ['clone', 'test-instance']
@@ -0,0 +1,216 @@
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import mirror
+import updater
+from instance import DiscordEdition
+
+VERSION = '0.0.42'
+TARBALL = os.urandom(256 * 1024)
+CHUNK_SIZE = 16 * 1024
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeUpstreamHandler)
+        self.requests = Counter()
+        self.chunk_delay = 0.0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    server: FakeUpstream
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        self.server.requests[path] += 1
+
+        if path == '/api/updates/stable':
+            body = f'{{"name": "{VERSION}"}}'.encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == f'/apps/linux/{VERSION}/discord-{VERSION}.tar.gz':
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(TARBALL)))
+            self.end_headers()
+            for i in range(0, len(TARBALL), CHUNK_SIZE):
+                time.sleep(self.server.chunk_delay)
+                self.wfile.write(TARBALL[i:i + CHUNK_SIZE])
+                self.wfile.flush()
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+class NoLengthHandler(BaseHTTPRequestHandler):
+    """A misconfigured mirror that answers everything without a Content-Length."""
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'not a tarball')
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture()
+def upstream(monkeypatch):
+    server = _serve(FakeUpstream())
+    monkeypatch.setattr(updater, 'API_ENDPOINT', f'{server.url}/api')
+    monkeypatch.setitem(updater.DL_ENDPOINTS, DiscordEdition.STABLE,
+                        server.url + '/apps/{plat}/{v}/discord-{v}.tar.gz')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def mirror_url(tmp_path, upstream):
+    server = _serve(mirror.MirrorServer(('127.0.0.1', 0), mirror.MirrorStore(path=str(tmp_path))))
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def dead_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f'http://127.0.0.1:{port}'
+
+
+@pytest.fixture(autouse=True)
+def reset_mirrors():
+    yield
+    updater.set_mirrors([])
+
+
+def _download(**kwargs):
+    for report in updater.download_instance(DiscordEdition.STABLE, VERSION, **kwargs):
+        if report.done:
+            return report.file.getvalue()
+    return None
+
+
+def test_manifest(upstream, mirror_url):
+    r = httpx.get(f'{mirror_url}/updates/stable', params={'platform': 'linux', 'version': '0.0.0'})
+    assert r.status_code == 200
+    assert r.json() == {'name': VERSION}
+
+    updater.set_mirrors([mirror_url])
+    assert updater.get_version(DiscordEdition.STABLE) == VERSION
+    assert upstream.requests['/api/updates/stable'] == 1
+
+
+def test_full_get(upstream, mirror_url):
+    r = httpx.get(f'{mirror_url}/apps/stable/{VERSION}.tar.gz')
+    assert r.status_code == 200
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert r.content == TARBALL
+
+
+def test_range(upstream, mirror_url):
+    url = f'{mirror_url}/apps/stable/{VERSION}.tar.gz'
+
+    r = httpx.get(url, headers={'Range': 'bytes=10-19'})
+    assert r.status_code == 206
+    assert r.headers['Content-Range'] == f'bytes 10-19/{len(TARBALL)}'
+    assert r.content == TARBALL[10:20]
+
+    r = httpx.get(url, headers={'Range': 'bytes=-5'})
+    assert r.status_code == 206
+    assert r.content == TARBALL[-5:]
+
+    r = httpx.get(url, headers={'Range': f'bytes={len(TARBALL)}-'})
+    assert r.status_code == 416
+    assert r.headers['Content-Range'] == f'bytes */{len(TARBALL)}'
+
+
+def test_fallback_in_order(upstream, mirror_url, dead_url):
+    updater.set_mirrors([dead_url, mirror_url])
+    assert updater.get_version(DiscordEdition.STABLE) == VERSION
+    assert _download() == TARBALL
+
+    # no working mirrors left, so discord itself is asked
+    updater.set_mirrors([dead_url])
+    assert _download() == TARBALL
+    assert upstream.requests[f'/apps/linux/{VERSION}/discord-{VERSION}.tar.gz'] == 2
+
+
+def test_fallback_on_missing_content_length(upstream, mirror_url):
+    server = _serve(ThreadingHTTPServer(('127.0.0.1', 0), NoLengthHandler))
+    try:
+        updater.set_mirrors([f'http://127.0.0.1:{server.server_port}', mirror_url])
+        assert _download() == TARBALL
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_cold_mirror_fetches_upstream_once(upstream, mirror_url, monkeypatch):
+    # the whole upstream download takes longer than the clients' read timeout,
+    # so they only succeed if the mirror streams while it is still fetching
+    upstream.chunk_delay = 0.1
+    monkeypatch.setattr(updater, 'MIRROR_TIMEOUT', httpx.Timeout(5.0, read=0.5))
+    updater.set_mirrors([mirror_url])
+
+    results = [None] * 3
+
+    def download(i):
+        results[i] = _download()
+
+    threads = [threading.Thread(target=download, args=(i,)) for i in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [TARBALL] * len(results)
+    assert upstream.requests[f'/apps/linux/{VERSION}/discord-{VERSION}.tar.gz'] == 1
+
+    # and it is served from the cache afterwards
+    assert _download() == TARBALL
+    assert upstream.requests[f'/apps/linux/{VERSION}/discord-{VERSION}.tar.gz'] == 1
+
+
+@pytest.mark.parametrize('error', [None, mirror.MirrorError('upstream broke')])
+def test_fetch_finishing_before_stream(tmp_path, upstream, mirror_url, monkeypatch, error):
+    # the fetch finishes between the handler looking it up and opening its temp file
+    path = tmp_path / 'finished.tar.gz'
+    path.write_bytes(TARBALL)
+    fetch = mirror._Fetch(str(path), str(tmp_path / '.tmp-gone'))
+    fetch.finish(error)
+    monkeypatch.setattr(mirror.MirrorStore, 'open_artifact', lambda *_: fetch)
+
+    r = httpx.get(f'{mirror_url}/apps/stable/{VERSION}.tar.gz')
+    if error is None:
+        assert r.status_code == 200
+        assert r.content == TARBALL
+    else:
+        assert r.status_code == 404
@@ -0,0 +1,170 @@
+import os
+import threading
+
+import pytest
+
+import updater
+from conftest import tarball_file
+from instance import DiscordEdition
+
+EDITION = DiscordEdition.STABLE
+
+
+@pytest.fixture()
+def instance(instance_man):
+    return instance_man.create('test-instance')
+
+
+def _staged(instance):
+    return sorted(e for e in os.listdir(instance.versions_dir) if not e.startswith('.'))
+
+
+def test_install_activates_atomically(instance):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+
+    assert os.path.islink(instance.app_dir.rstrip('/'))
+    assert updater.get_active_version(instance) == '0.0.1'
+    assert instance.version == '0.0.1'
+    assert updater.get_previous_version(instance) is None
+
+
+def test_upgrade_keeps_previous_for_rollback(instance):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+    updater.install_update(instance, EDITION, tarball_file('0.0.2'))
+
+    assert instance.version == '0.0.2'
+    assert updater.get_previous_version(instance) == '0.0.1'
+
+    assert updater.rollback(instance) == '0.0.1'
+    assert instance.version == '0.0.1'
+    # rolling back is symmetric, so it can be undone as well
+    assert updater.get_previous_version(instance) == '0.0.2'
+
+
+def test_rollback_without_previous(instance):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+
+    with pytest.raises(updater.UpdateError):
+        updater.rollback(instance)
+
+
+def test_prefetch_is_applied_on_demand(instance):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+    name = updater.prefetch_update(instance, EDITION, tarball_file('0.0.2'))
+
+    assert updater.get_pending_version(instance) == name
+    assert instance.version == '0.0.1'
+
+    assert updater.apply_pending_update(instance) == name
+    assert instance.version == '0.0.2'
+    assert updater.get_pending_version(instance) is None
+    assert updater.apply_pending_update(instance) is None
+
+
+def test_rollback_discards_pending(instance):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+    updater.install_update(instance, EDITION, tarball_file('0.0.2'))
+    updater.prefetch_update(instance, EDITION, tarball_file('0.0.3'))
+
+    updater.rollback(instance)
+
+    assert updater.get_pending_version(instance) is None
+    assert updater.apply_pending_update(instance) is None
+    assert instance.version == '0.0.1'
+
+
+def test_prune_keeps_active_previous_and_pending(instance):
+    for version in ('0.0.1', '0.0.2', '0.0.3'):
+        updater.install_update(instance, EDITION, tarball_file(version))
+    updater.prefetch_update(instance, EDITION, tarball_file('0.0.4'))
+
+    assert _staged(instance) == ['0.0.2', '0.0.3', '0.0.4']
+
+
+def test_prune_keeps_versions_in_use(instance, monkeypatch):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+    monkeypatch.setattr(updater, '_get_versions_in_use', lambda _: {'0.0.1'})
+    updater.install_update(instance, EDITION, tarball_file('0.0.2'))
+    updater.install_update(instance, EDITION, tarball_file('0.0.3'))
+
+    assert _staged(instance) == ['0.0.1', '0.0.2', '0.0.3']
+
+    monkeypatch.setattr(updater, '_get_versions_in_use', lambda _: set())
+    updater.prune_versions(instance)
+
+    assert _staged(instance) == ['0.0.2', '0.0.3']
+
+
+def test_reinstalling_same_version(instance):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+
+    assert updater.get_active_version(instance) == '0.0.1-1'
+    assert instance.version == '0.0.1'
+
+
+def test_legacy_app_dir_is_migrated(instance):
+    # install the pre-staging way, straight into the app dir
+    updater._extract_update(instance.app_dir, EDITION, tarball_file('0.0.1'), updater.InstallProfile())
+    assert not os.path.islink(instance.app_dir.rstrip('/'))
+
+    updater.install_update(instance, EDITION, tarball_file('0.0.2'))
+
+    assert instance.version == '0.0.2'
+    assert updater.rollback(instance) == '0.0.1'
+    assert instance.version == '0.0.1'
+
+
+def test_prune_waits_for_versions_lock(instance):
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'))
+    pruned = threading.Event()
+
+    def prune():
+        updater.prune_versions(instance)
+        pruned.set()
+
+    with updater._versions_lock(instance):
+        # e.g. another process that just renamed a staged version into place but hasn't marked it yet
+        os.makedirs(os.path.join(instance.versions_dir, '0.0.2'))
+        thread = threading.Thread(target=prune)
+        thread.start()
+
+        assert not pruned.wait(0.2)
+        updater._write_marker(instance, updater.PENDING_MARKER, '0.0.2')
+
+    thread.join()
+    assert _staged(instance) == ['0.0.1', '0.0.2']
+
+
+def _installed_locales(instance):
+    return sorted(os.listdir(os.path.join(instance.app_dir, 'locales')))
+
+
+def test_locales_profile(instance):
+    profile = updater.InstallProfile(locales=frozenset({'nl'}))
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'), profile)
+
+    assert _installed_locales(instance) == ['en-US.pak', 'nl.pak']
+    assert sorted(updater.get_install_manifest(instance)['skipped']) == ['locales/de.pak', 'locales/fr.pak']
+
+    # later upgrades reuse the profile
+    updater.install_update(instance, EDITION, tarball_file('0.0.2'))
+    assert _installed_locales(instance) == ['en-US.pak', 'nl.pak']
+    assert updater.get_install_profile(instance) == profile
+
+
+def test_locales_are_case_insensitive(instance):
+    profile = updater.InstallProfile(locales=frozenset({'en-us', 'NL'}))
+    updater.install_update(instance, EDITION, tarball_file('0.0.1'), profile)
+
+    assert _installed_locales(instance) == ['en-US.pak', 'nl.pak']
+
+
+def test_unknown_locale_is_rejected(instance):
+    profile = updater.InstallProfile(locales=frozenset({'nl', 'xx-typo'}))
+
+    with pytest.raises(updater.UpdateError, match='xx-typo'):
+        updater.install_update(instance, EDITION, tarball_file('0.0.1'), profile)
+
+    assert _staged(instance) == []
+    assert updater.get_active_version(instance) is None
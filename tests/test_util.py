@@ -0,0 +1,116 @@
+import errno
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+import util
+
+
+@pytest.fixture()
+def tree(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'file').write_text('file')
+    (src / 'sub' / 'nested').write_text('nested')
+    (src / 'link').symlink_to('file')
+    (src / 'dir-link').symlink_to('sub', target_is_directory=True)
+    (src / 'SingletonLock').write_text('lock')
+    (src / 'Cache').mkdir()
+    (src / 'Cache' / 'entry').write_text('entry')
+    os.chmod(src / 'sub', 0o700)
+    return src
+
+
+@pytest.fixture()
+def ioctl_calls(monkeypatch):
+    """Makes reflinks fail the way they do on filesystems that don't support them."""
+    calls = []
+
+    def ioctl(fd, request, arg):
+        calls.append(request)
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+    monkeypatch.setattr(util, 'fcntl', SimpleNamespace(ioctl=ioctl))
+    return calls
+
+
+def _nlinks(root):
+    return {name: os.stat(root / name).st_nlink for name in ('file', 'sub/nested')}
+
+
+def test_clone_tree_layout(tree, tmp_path, ioctl_calls):
+    dst = tmp_path / 'dst'
+
+    util.clone_tree(str(tree), str(dst), exclude=('Singleton*', 'Cache'))
+
+    assert sorted(os.listdir(dst)) == ['dir-link', 'file', 'link', 'sub']
+    assert os.readlink(dst / 'link') == 'file'
+    assert os.readlink(dst / 'dir-link') == 'sub'
+    assert (dst / 'sub' / 'nested').read_text() == 'nested'
+    assert os.stat(dst / 'sub').st_mode & 0o777 == 0o700
+
+
+def test_clone_tree_reflink(tree, tmp_path, monkeypatch):
+    def ioctl(fd, request, arg):
+        assert request == util.FICLONE
+        os.write(fd, os.pread(arg, 1024, 0))
+
+    def link(src, dst):
+        raise AssertionError('should not hardlink when reflinks work')
+
+    monkeypatch.setattr(util, 'fcntl', SimpleNamespace(ioctl=ioctl))
+    monkeypatch.setattr(os, 'link', link)
+    dst = tmp_path / 'dst'
+
+    util.clone_tree(str(tree), str(dst), hardlink=True)
+
+    assert (dst / 'file').read_text() == 'file'
+    assert _nlinks(dst) == {'file': 1, 'sub/nested': 1}
+    assert os.stat(dst / 'file').st_mtime == os.stat(tree / 'file').st_mtime
+
+
+def test_clone_tree_hardlink_fallback(tree, tmp_path, ioctl_calls):
+    dst = tmp_path / 'dst'
+
+    util.clone_tree(str(tree), str(dst), hardlink=True, workers=1)
+
+    assert _nlinks(dst) == {'file': 2, 'sub/nested': 2}
+    # unsupported reflinks are not attempted again
+    assert ioctl_calls == [util.FICLONE]
+
+
+def test_clone_tree_copy_fallback(tree, tmp_path, ioctl_calls, monkeypatch):
+    dst = tmp_path / 'dst'
+    util.clone_tree(str(tree), str(dst))
+    assert _nlinks(dst) == {'file': 1, 'sub/nested': 1}
+
+    def link(src, dst):
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+    monkeypatch.setattr(os, 'link', link)
+    shutil.rmtree(dst)
+    util.clone_tree(str(tree), str(dst), hardlink=True)
+    assert _nlinks(dst) == {'file': 1, 'sub/nested': 1}
+    assert (dst / 'sub' / 'nested').read_text() == 'nested'
+
+
+def test_reflink_errors(tmp_path, monkeypatch):
+    def ioctl(fd, request, arg):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    monkeypatch.setattr(util, 'fcntl', SimpleNamespace(ioctl=ioctl))
+    cloner = util._TreeCloner(hardlink=False)
+    (tmp_path / 'src').write_text('src')
+
+    # the original error surfaces, not a failure to clean up a file that was never created
+    with pytest.raises(FileNotFoundError) as exc_info:
+        cloner.copy_file(str(tmp_path / 'missing'), str(tmp_path / 'dst'))
+    assert exc_info.value.filename == str(tmp_path / 'missing')
+
+    with pytest.raises(OSError) as exc_info:
+        cloner.copy_file(str(tmp_path / 'src'), str(tmp_path / 'dst'))
+    assert exc_info.value.errno == errno.EIO
+    assert not (tmp_path / 'dst').exists()
+    assert cloner.use_reflink